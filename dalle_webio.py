@@ -3,12 +3,15 @@ import re
 import sys
 import logging
 import json
+import html
 import time
+from string import Template
 from io import BytesIO
+from functools import cached_property
 from pathlib import Path
 from collections import deque
 
-from aiohttp import ClientSession, ClientConnectionError
+from aiohttp import ClientSession, ClientConnectionError, ClientTimeout, TCPConnector
 from pywebio.input import input as input_text, input_group
 from pywebio.output import put_row, put_column, put_scope, clear, remove, toast, popup
 from pywebio.output import put_buttons, put_text, put_image, put_html, put_loading
@@ -18,11 +21,24 @@ from pywebio import start_server, config
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 
 AS_IS_PREFIX = "I NEED to test how the tool works with extremely simple prompts. DO NOT add any detail, just use it AS-IS:"
 INVALID_CHARS_REGEX = r"[\\/*?\"<>|]"
 MAX_PATH_LEN = 200
 LEAST_NAME_LEN = 10
+KEEPALIVE_TIMEOUT = 120
+DNS_CACHE_TTL = 300
+MAX_CONCURRENCY = 8
+CLIENT_TIMEOUT = ClientTimeout(total=180, connect=15, sock_read=60)
+
+_AS_IS_PREFIX_SP = AS_IS_PREFIX + " "
+_INVALID_CHARS_RE = re.compile(INVALID_CHARS_REGEX)
+_RETRY_RE = re.compile(r"retry after (\d+) second")
 
 INPUT_BUTTON_GROUP_CSS = "display: flex; justify-content: center; margin-top: 8px; gap: 8px"
 CELL_CSS = "min-height: 265px"
@@ -46,6 +62,25 @@ RESULT_CSS = """
     max-height: 800px;
 """
 
+PROMPT_HTML_TMPL = Template(
+    '<p style="$css"><b>Prompt: </b>$prompt</p>'
+    '<p style="$css"><b>Revised: </b>$revised</p>'
+)
+
+
+def _prompt_html(prompt: str, revised_prompt: str, css: str) -> str:
+    return PROMPT_HTML_TMPL.substitute(
+        css=css, 
+        prompt=html.escape(prompt), 
+        revised=html.escape(revised_prompt)
+    )
+
+
+def _decode_img(data: bytes) -> Image:
+    img = Image.open(BytesIO(data))
+    img.load()
+    return img
+
 
 class DalleImage:
     def __init__(self, prompt, revised_prompt, img: Image):
@@ -53,11 +88,15 @@ class DalleImage:
         self.revised_prompt = revised_prompt
         self.img = img
 
-    def save(self, save_path: Path):
+    @cached_property
+    def _pnginfo(self):
         info = PngInfo()
         info.add_text("prompt", self.prompt)
         info.add_text("revised_prompt", self.revised_prompt)
-        self.img.save(save_path, pnginfo=info)
+        return info
+
+    def save(self, save_path: Path):
+        self.img.save(save_path, pnginfo=self._pnginfo, compress_level=1, optimize=False)
 
 
 class RateLimiter:  
@@ -67,7 +106,7 @@ class RateLimiter:
 
 
     def allow(self):  
-        now = time.time()
+        now = time.monotonic()
         if len(self.stamps) < self.stamps.maxlen or now - self.stamps[0] > self.period:
             self.stamps.append(now)
             return True
@@ -76,7 +115,7 @@ class RateLimiter:
   
     async def wait(self, extra_wait=0):  
         while not self.allow(): 
-            sleep_sec = self.stamps[0] + self.period - time.time() + extra_wait
+            sleep_sec = self.stamps[0] + self.period - time.monotonic() + extra_wait
             await asyncio.sleep(sleep_sec)  
 
 
@@ -85,18 +124,36 @@ class DalleClient:
         self.deployment = init_inputs["deployment"]
         self.dalle_session = ClientSession(
             base_url=init_inputs["endpoint"], 
-            headers={"api-key": init_inputs["key"]}
+            headers={"api-key": init_inputs["key"]},
+            connector=self._make_connector(init_inputs["rpm"]),
+            timeout=CLIENT_TIMEOUT
+        )
+        self.img_session = ClientSession(
+            connector=self._make_connector(init_inputs["rpm"]),
+            timeout=CLIENT_TIMEOUT
         )
-        self.img_session = ClientSession()
         self.limiter = RateLimiter(allowance=init_inputs["rpm"], period=60)
+        self.gate = asyncio.Semaphore(min(init_inputs["rpm"], MAX_CONCURRENCY))
+        self._tasks = set()
+        self._next_stamp = 0
 
 
     async def close_client(self):
-        await asyncio.create_task(self.dalle_session.close())
-        await asyncio.create_task(self.img_session.close())
+        await self.dalle_session.close()
+        await self.img_session.close()
         logging.info("Client closed")
 
 
+    @staticmethod
+    def _make_connector(rpm):
+        return TCPConnector(
+            limit=max(8, rpm),
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            enable_cleanup_closed=True
+        )
+
+
     async def _call_dalle(self, prompt, **kwargs):
         api_version = kwargs.get("api_version", "2024-02-01")
         size = kwargs.get("size", "1024x1024")
@@ -117,8 +174,8 @@ class DalleClient:
                 result = await resp.json()
                 result["status"] = resp.status
                 result["reason"] = resp.reason
-        except ClientConnectionError as e:
-            logging.error("Connection Error when calling Dalle: %s", e)
+        except (ClientConnectionError, asyncio.TimeoutError) as e:
+            logging.error("Connection Error when calling Dalle: %r", e)
             return None
         return result
     
@@ -129,7 +186,7 @@ class DalleClient:
             return None
         if result["status"] == 429:
             msg = result["error"]["message"]
-            wait_sec_match = re.search(r"retry after (\d+) second", msg)
+            wait_sec_match = _RETRY_RE.search(msg)
             if not wait_sec_match:
                 toast(f"Failed request: {result['status']} {result['reason']}: {msg}", color="warn", duration=5)
                 logging.warning("Failed request: %d %s: %s", result["status"], result["reason"], msg)
@@ -153,42 +210,44 @@ class DalleClient:
         try:
             logging.info("Getting generated image")
             async with self.img_session.get(img_url) as response:
-                img = Image.open(BytesIO(await response.read()))
-        except ClientConnectionError as e:
-            logging.error("Connection Error when getting image: %s", e)
+                data = await response.read()
+            img = await asyncio.get_running_loop().run_in_executor(None, _decode_img, data)
+        except (ClientConnectionError, asyncio.TimeoutError) as e:
+            logging.error("Connection Error when getting image: %r", e)
+            return None
+        except OSError as e:
+            logging.error("Failed to decode image: %s", e)
             return None
         return img
     
 
-    def _prepare_img_path(self, save_dir: Path, prompt: str, suffix: str):
-        sanitized_prompt = re.sub(INVALID_CHARS_REGEX, "_", prompt)
+    def _prepare_img_stem(self, save_dir: Path, prompt: str, suffix_len: int):
+        sanitized_prompt = _INVALID_CHARS_RE.sub("_", prompt)
         save_dir_path_len = len(str(save_dir.resolve()))
-        allowed_name_len = MAX_PATH_LEN - save_dir_path_len - len(suffix) - LEAST_NAME_LEN
+        allowed_name_len = MAX_PATH_LEN - save_dir_path_len - suffix_len - LEAST_NAME_LEN
         if allowed_name_len <= 0:
             toast("The file path is too long, please choose another save directory", color="error", duration=5)
-            logging.error("The file path is too long", color="error", duration=5)
+            logging.error("The file path is too long")
             return None
-        if not save_dir.exists():
-            save_dir.mkdir()
-        if len(sanitized_prompt) + len(suffix) > allowed_name_len:
-            get_length = allowed_name_len - len(suffix) - 3
-            sanitized_prompt = sanitized_prompt[:get_length] + "..."
-        return save_dir / (sanitized_prompt + suffix)
+        save_dir.mkdir(parents=True, exist_ok=True)
+        if len(sanitized_prompt) + suffix_len > allowed_name_len:
+            get_length = allowed_name_len - suffix_len - 3
+            return f"{sanitized_prompt[:get_length]}..."
+        return sanitized_prompt
     
 
-    async def generate_one_image(self, save_dir: Path, stamp: str, as_is: bool, prompt: str, **kwargs):
-        img_path = self._prepare_img_path(save_dir, prompt, f"-{stamp}.png")
-        if not img_path:
-            return
-        full_prompt = f"{AS_IS_PREFIX} {prompt}" if as_is else prompt
+    async def generate_one_image(self, img_path: Path, stamp: str, as_is: bool, prompt: str, **kwargs):
+        full_prompt = _AS_IS_PREFIX_SP + prompt if as_is else prompt
 
         put_scope(stamp, scope="result", position=0).style(CELL_CSS)
         put_loading(scope=stamp)
-        put_text("Waiting...", scope=stamp)
-        await self.limiter.wait(extra_wait=1)
+        if not self.limiter.allow():
+            put_text("Waiting...", scope=stamp)
+            await self.limiter.wait(extra_wait=1)
 
         put_text("Generating...", scope=stamp)
-        result = await asyncio.create_task(self._call_dalle(full_prompt, **kwargs))
+        async with self.gate:
+            result = await self._call_dalle(full_prompt, **kwargs)
         result = self._process_dalle_response(result)
         if not result:
             remove(stamp)
@@ -196,7 +255,8 @@ class DalleClient:
 
         put_text("Getting Image...", scope=stamp)
         revised_prompt, img_url = result
-        img = await asyncio.create_task(self._get_img(img_url))
+        async with self.gate:
+            img = await self._get_img(img_url)
         if not img:
             toast("Fail to get image", color="error")
             remove(stamp)
@@ -252,16 +312,15 @@ class DalleClient:
             put_column(
                 content=[
                     put_image(dalle_img.img), None,
-                    put_html(f"<p><b>Prompt: </b>{dalle_img.prompt}</p>").style(ZOOM_CARD_PROMPT_CSS),
-                    put_html(f"<p><b>Revised: </b>{dalle_img.revised_prompt}</p>").style(ZOOM_CARD_PROMPT_CSS),
+                    put_html(_prompt_html(dalle_img.prompt, dalle_img.revised_prompt, ZOOM_CARD_PROMPT_CSS)),
                 ],
-                size="auto 10px auto auto 10px 50px"
+                size="auto 10px auto"
             ).style(ZOOM_CARD_CSS)
         ])
 
     
-    def save_img(self, dalle_img: DalleImage, img_path: Path):
-        dalle_img.save(img_path)
+    async def save_img(self, dalle_img: DalleImage, img_path: Path):
+        await asyncio.get_running_loop().run_in_executor(None, dalle_img.save, img_path)
         info_str = f"Saved to {img_path.name}"
         toast(info_str)
         logging.info(info_str)
@@ -275,8 +334,7 @@ class DalleClient:
         put_column(
             content=[
                 put_image(dalle_img.img), None,
-                put_html(f"<p><b>Prompt: </b>{dalle_img.prompt}</p>").style(IMG_CARD_PROMPT_CSS),
-                put_html(f"<p><b>Revised: </b>{dalle_img.revised_prompt}</p>").style(IMG_CARD_PROMPT_CSS), None,
+                put_html(_prompt_html(dalle_img.prompt, dalle_img.revised_prompt, IMG_CARD_PROMPT_CSS)), None,
                 put_buttons(
                     buttons=["zoom", "save", "delete"], 
                     onclick=[
@@ -293,7 +351,7 @@ class DalleClient:
                     ]
                 ).style(CARD_BUTTON_GROUP_CSS)
             ], 
-            size="auto 10px auto auto 10px 50px",
+            size="auto 10px auto 10px 50px",
             scope=scope
         ).style(IMG_CARD_CSS)
 
@@ -312,24 +370,35 @@ class DalleClient:
             toast("Prompt is empty", color="error", duration=3)
             return
         
-        if not num:
+        if not num or num < 1:
             toast("Num must be an positive integer", color="error", duration=3)
             return
 
         save_dir = Path(save_dir)
         as_is = bool(as_is[0]) if as_is else False
 
-        timestamp = int(time.time() * 1_000_000)
-        for i in range(num):
-            stamp = str(timestamp + i)
-            run_async(self.generate_one_image(
-                save_dir=save_dir, stamp=stamp, as_is=as_is,
+        # microsecond stamps, kept past the previous batch so fast clicks never collide
+        timestamp = max(time.time_ns() // 1000, self._next_stamp)
+        stamps = [str(timestamp + i) for i in range(num)]
+        img_stem = self._prepare_img_stem(save_dir, prompt, len(f"-{stamps[-1]}.png"))
+        if img_stem is None:
+            return
+        self._next_stamp = timestamp + num
+
+        self._tasks = {task for task in self._tasks if not task.closed()}
+        for stamp in stamps:
+            img_path = save_dir / f"{img_stem}-{stamp}.png"
+            self._tasks.add(run_async(self.generate_one_image(
+                img_path=img_path, stamp=stamp, as_is=as_is,
                 prompt=prompt, api_version=api_version, style=style, quality=quality, size=size,
-            ))
+            )))
 
 
     async def exit_session(self):
-        await asyncio.create_task(self.close_client())
+        for task in self._tasks:
+            if not task.closed():
+                task.close()
+        await self.close_client()
         toast("Exited", color="error")
         sys.exit()
 
@@ -343,8 +412,8 @@ def read_settings(setting_path: Path):
     logging.info(found_str)
     try:
         with setting_path.open("r", encoding="utf-8") as fp:
-            return json.load(fp)
-    except json.decoder.JSONDecodeError:
+            return json_loads(fp.read())
+    except (OSError, json.decoder.JSONDecodeError):
         fail_str = "Failed to parse setting file"
         toast(fail_str, color="error", duration=5)
         logging.error(fail_str)